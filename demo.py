@@ -7,3 +7,9 @@ print("Hello world!");
 
 def notSnakeCase(var=[]):
     pass
+text = ('''part one'''
+     'part two'  # TODO this comment is code, not part of a string
+     'part three')
+doc = """
+  not code; # todo
+"""
@@ -1,7 +1,31 @@
 import ast
-import os.path
+import heapq
+import io
+import os
 import re
-from typing import List, Callable, Tuple
+import stat
+import tokenize
+from operator import itemgetter
+from typing import Iterator, List, Callable, NamedTuple, Tuple, Union
+
+_DEF_SPACES_RE = re.compile('def {2,}[a-zA-Z_]')
+_CLASS_SPACES_RE = re.compile('class {2,}[a-zA-Z_]')
+_CLASS_DECL_RE = re.compile('class \\w*\\s*:')
+_CLASS_NAME_RE = re.compile('class [A-Z]+([a-z0-9]|([A-Z0-9][a-z0-9]+))*([A-Z])?\\s*:')
+_DEF_DECL_RE = re.compile('def \\w*\\s*')
+_DEF_NAME_RE = re.compile('def ([a-z_]+(_[a-zA-Z]+)*|__[a-z]+(_[a-zA-Z]+)*__)')
+_SNAKE_RE = re.compile('([a-z]+(_[a-zA-Z]+)*|__[a-z]+(_[a-zA-Z]+)*__)')
+
+# Line features a checker needs before it can possibly fail
+_LONG = 1
+_HASH = 2
+_SEMICOLON = 4
+_DEF = 8
+_CLASS = 16
+_BLANKS = 32
+
+_FSTRING_START = getattr(tokenize, 'FSTRING_START', None)
+_FSTRING_END = getattr(tokenize, 'FSTRING_END', None)
 
 
 class AstVisitor(ast.NodeVisitor):
@@ -9,6 +33,18 @@ class AstVisitor(ast.NodeVisitor):
         self.vars: dict = {}
         self.arguments: dict = {}
         self.mut_defaults: set = set()
+        # Resolved once so visit() avoids a getattr on 'visit_' + name per node
+        self._handlers: dict = {
+            ast.FunctionDef: self.visit_FunctionDef,
+            ast.AsyncFunctionDef: self.visit_AsyncFunctionDef,
+            ast.Name: self.visit_Name,
+        }
+
+    def visit(self, node):
+        handler = self._handlers.get(node.__class__)
+        if handler is None:
+            return self.generic_visit(node)
+        return handler(node)
 
     def visit_FunctionDef(self, node):
         for arg in node.args.args:
@@ -32,186 +68,250 @@ class AstVisitor(ast.NodeVisitor):
         self.generic_visit(node)
 
 
+# Pieces of a source line shared by every checker, computed once per line
+class LineContext(NamedTuple):
+    line: str
+    lstripped: str
+    hash_idx: int
+    # Text before the first '#', right-stripped
+    code: str
+    # Number of blank lines directly before this one
+    blank_before: int
+    # Bitwise OR of the _LONG, _HASH, ... features present in the line
+    flags: int
+
+
+def line_context(line: str, blank_before: int = 0) -> LineContext:
+    lstripped = line.lstrip()
+    hash_idx = line.find('#')
+    code = line[:hash_idx] if hash_idx >= 0 else line
+    flags = 0
+    if len(line) > 79:
+        flags |= _LONG
+    if hash_idx >= 0:
+        flags |= _HASH
+    if ';' in line:
+        flags |= _SEMICOLON
+    # Only lines opening a definition are handed to the def/class regexes, which
+    # also keeps them off mentions of the keywords in comments and strings
+    if lstripped.startswith(('def ', 'async def ')):
+        flags |= _DEF
+    elif lstripped.startswith('class '):
+        flags |= _CLASS
+    if blank_before > 2:
+        flags |= _BLANKS
+    return LineContext(line, lstripped, hash_idx, code.rstrip(), blank_before, flags)
+
+
+# A check returns True when the line passes, False to report the checker's msg,
+# or a string to report that message instead
 class StyleChecker:
-    def __init__(self, check_fn: Callable[[str], bool], code: int, msg: str):
+    def __init__(self, check_fn: Callable[[LineContext], Union[bool, str]], code: int, msg: str, requires: int = 0,
+                 in_strings: bool = False):
         self.check_fn = check_fn
         self.code = code
         self.msg = msg
+        # Line flags of which at least one must be set for this check to run; 0 means always run
+        self.requires = requires
+        # Whether the check also applies to lines inside a multiline string literal
+        self.in_strings = in_strings
 
-    def check(self, line: str) -> bool:
-        return self.check_fn(line)
+    def check(self, ctx: LineContext) -> Union[bool, str]:
+        return self.check_fn(ctx)
 
     @classmethod
     def length_checker(cls):
-        return StyleChecker(lambda x: len(x) <= 79, 1, 'Too long')
+        return StyleChecker(lambda x: len(x.line) <= 79, 1, 'Too long', _LONG, in_strings=True)
 
     @classmethod
     def indent_checker(cls):
-        return StyleChecker(lambda x: (len(x) - len(x.lstrip())) % 4 == 0, 2, 'Indentation is not a multiple of four')
+        return StyleChecker(lambda x: (len(x.line) - len(x.lstripped)) % 4 == 0, 2, 'Indentation is not a multiple of four')
 
     @classmethod
     def semicolon_checker(cls):
-        def check(line: str) -> bool:
-            line = line.split('#')[0]
-            line = line.rstrip()
-            if len(line) == 0:
-                return True
-            return not (line[-1] == ';' and
-                        (line.lstrip()[0] != '#' or
-                         len(line.lstrip()) > 3 and line[:3] != "'''" and line[:3] != '"""'))
-        return StyleChecker(check, 3, 'Unnecessary semicolon')
+        def check(ctx: LineContext) -> bool:
+            return not ctx.code.endswith(';')
+        return StyleChecker(check, 3, 'Unnecessary semicolon', _SEMICOLON)
 
     @classmethod
     def comment_spaces_checker(cls):
-        def check(line: str) -> bool:
-            sides = line.split('#', 2)
-            if len(sides) < 2:
-                return True
-            left_side = sides[0]
-            left_side = left_side.lstrip()
-            if len(left_side) == 0:
+        def check(ctx: LineContext) -> bool:
+            if ctx.hash_idx == -1 or len(ctx.code) == 0:
                 return True
-            return len(left_side) >= 2 and len(left_side) - len(left_side.rstrip()) >= 2
-        return StyleChecker(check, 4, 'At least two spaces required before inline comment')
+            return ctx.hash_idx - len(ctx.code) >= 2
+        return StyleChecker(check, 4, 'At least two spaces required before inline comment', _HASH)
 
     @classmethod
     def todo_checker(cls):
-        def check(line: str) -> bool:
-            idx = line.find('#')
-            if idx == -1:
+        def check(ctx: LineContext) -> bool:
+            if ctx.hash_idx == -1:
                 return True
-            comment = line[idx:].lower()
+            comment = ctx.line[ctx.hash_idx:].lower()
             return not comment.find('todo') > -1
-        return StyleChecker(check, 5, 'TODO found')
+        return StyleChecker(check, 5, 'TODO found', _HASH)
 
     @classmethod
-    def blank_lines_checker(cls, blank_fn: Callable[[], int]):
-        class BlankLines(StyleChecker):
-            def __init__(self):
-                def check(line: str) -> bool:
-                    length = len(line.strip())
-                    if length == 0:
-                        return True
-                    return blank_fn() <= 2
-                super().__init__(check, 6, 'More than two blank lines found before this line')
-        return BlankLines()
+    def blank_lines_checker(cls):
+        return StyleChecker(lambda x: x.blank_before <= 2, 6, 'More than two blank lines found before this line', _BLANKS)
 
     @classmethod
     def def_spaces_checker(cls):
-        def check(line: str) -> bool:
-            regex = re.compile('def {2,}[a-zA-Z_]')
-            return len(regex.findall(line)) == 0
-        return StyleChecker(check, 7, 'Too many spaces after \'def\'')
+        def check(ctx: LineContext) -> bool:
+            return _DEF_SPACES_RE.search(ctx.line) is None
+        return StyleChecker(check, 7, 'Too many spaces after \'def\'', _DEF)
 
     @classmethod
     def class_spaces_checker(cls):
-        def check(line: str) -> bool:
-            regex = re.compile('class {2,}[a-zA-Z_]')
-            return len(regex.findall(line)) == 0
-        return StyleChecker(check, 7, 'Too many spaces after \'class\'')
+        def check(ctx: LineContext) -> bool:
+            return _CLASS_SPACES_RE.search(ctx.line) is None
+        return StyleChecker(check, 7, 'Too many spaces after \'class\'', _CLASS)
 
     @classmethod
     def camelcase_checker(cls):
-        class Camelcase(StyleChecker):
-            def __init__(self):
-                self.msg: str = ''
-
-                def check(line: str) -> bool:
-                    class_match = re.search('class \\w*\\s*:', line)
-                    if not class_match:
-                        return True
-                    result = re.match('class [A-Z]+([a-z0-9]|([A-Z0-9][a-z0-9]+))*([A-Z])?\\s*:',
-                                    class_match.group())
-                    if result is None:
-                        self.msg = f'Class name \'{class_match.group()[6:-1].strip()}\' should use CamelCase'
-                        return False
-                    return True
-
-                super().__init__(check, 8, self.msg)
-        return Camelcase()
+        def check(ctx: LineContext) -> Union[bool, str]:
+            class_match = _CLASS_DECL_RE.search(ctx.line)
+            if not class_match:
+                return True
+            result = _CLASS_NAME_RE.match(class_match.group())
+            if result is None:
+                return f'Class name \'{class_match.group()[6:-1].strip()}\' should use CamelCase'
+            return True
+        return StyleChecker(check, 8, 'Class name should use CamelCase', _CLASS)
 
     @classmethod
     def snakecase_checker(cls):
-        class Snakecase(StyleChecker):
-            def __init__(self):
-                self.msg: str = ''
-
-                def check(line: str) -> bool:
-                    fn_match = re.search('def \\w*\\s*', line)
-                    if not fn_match:
-                        return True
-                    result = re.match('def ([a-z_]+(_[a-zA-Z]+)*|__[a-z]+(_[a-zA-Z]+)*__)', fn_match.group())
-                    if result is None:
-                        self.msg = f'Function name \'{fn_match.group()[4:-1].strip()}\' should use snake_case'
-                        return False
-                    return True
-
-                super().__init__(check, 9, self.msg)
-        return Snakecase()
+        def check(ctx: LineContext) -> Union[bool, str]:
+            fn_match = _DEF_DECL_RE.search(ctx.line)
+            if not fn_match:
+                return True
+            result = _DEF_NAME_RE.match(fn_match.group())
+            if result is None:
+                return f'Function name \'{fn_match.group()[4:-1].strip()}\' should use snake_case'
+            return True
+        return StyleChecker(check, 9, 'Function name should use snake_case', _DEF)
 
 
+# Both name patterns are matched as prefixes, so a leading [a-z] (resp. [A-Z])
+# already decides the result without entering the regex engine
 def is_snakecase(value: str) -> bool:
-    return re.match('([a-z]+(_[a-zA-Z]+)*|__[a-z]+(_[a-zA-Z]+)*__)', value) is not None
+    if 'a' <= value[:1] <= 'z':
+        return True
+    return _SNAKE_RE.match(value) is not None
 
 
 def is_camelcase(value: str) -> bool:
-    return re.match('[A-Z]+([a-z0-9]|([A-Z0-9][a-z0-9]+))*([A-Z])?', value) is not None
+    return 'A' <= value[:1] <= 'Z'
+
+
+# Flags, by 1-based line number, the lines lying wholly inside a string token.
+# Tokens are used rather than AST nodes because an implicitly concatenated
+# literal is one ast.Constant whose span also covers the code between its parts
+def string_body_lines(source: str, line_total: int) -> bytearray:
+    in_string = bytearray(line_total + 1)
+    # Since 3.12 an f-string is split into FSTRING_START ... FSTRING_END tokens
+    fstring_starts: List[int] = []
+    for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+        if tok.type == tokenize.STRING:
+            start = tok.start[0]
+        elif tok.type == _FSTRING_START:
+            fstring_starts.append(tok.start[0])
+            continue
+        elif tok.type == _FSTRING_END:
+            start = fstring_starts.pop()
+        else:
+            continue
+        end = tok.end[0]
+        if end - start > 1:
+            in_string[start + 1:end] = b'\x01' * (end - start - 1)
+    return in_string
+
+
+# Checkers hold no per-file state, so they are built once and shared by every FileSCA
+_CHECKERS: List[StyleChecker] = [
+    StyleChecker.length_checker(),
+    StyleChecker.indent_checker(),
+    StyleChecker.semicolon_checker(),
+    StyleChecker.comment_spaces_checker(),
+    StyleChecker.todo_checker(),
+    StyleChecker.blank_lines_checker(),
+    StyleChecker.def_spaces_checker(),
+    StyleChecker.class_spaces_checker(),
+    StyleChecker.camelcase_checker(),
+    StyleChecker.snakecase_checker(),
+]
+
 
 class FileSCA:
     def __init__(self, filename):
-        if not os.path.exists(filename):
-            raise FileNotFoundError(f'{filename} does not exist')
-        if not os.path.isfile(filename):
+        # One stat() covers both the existence and the regular file check
+        try:
+            mode = os.stat(filename).st_mode
+        except OSError:
+            # os.path.exists() treated any stat() failure as a missing path
+            raise FileNotFoundError(f'{filename} does not exist') from None
+        if not stat.S_ISREG(mode):
             raise Exception(f'{filename} is not a file')
 
-        self.blank_count = 0
         self.file_name = filename
         # self.in_multiline_comment = False
-        self.errors: List[Tuple[int, str]] = []
-        self.checkers: List[StyleChecker] = [
-            StyleChecker.length_checker(),
-            StyleChecker.indent_checker(),
-            StyleChecker.semicolon_checker(),
-            StyleChecker.comment_spaces_checker(),
-            StyleChecker.todo_checker(),
-            StyleChecker.blank_lines_checker(lambda: self.blank_count),
-            StyleChecker.def_spaces_checker(),
-            StyleChecker.class_spaces_checker(),
-            StyleChecker.camelcase_checker(),
-            StyleChecker.snakecase_checker()
-        ]
-
-    def analyze(self):
+        self.checkers: List[StyleChecker] = _CHECKERS
+
+    def analyze(self) -> Iterator[Tuple[int, str]]:
+        with open(self.file_name, 'rb') as f:
+            data = f.read()
+        # Honour a UTF-8 BOM or PEP 263 coding cookie the way the interpreter does
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+        source = data.decode(encoding)
+        if '\r' in source:
+            source = source.replace('\r\n', '\n').replace('\r', '\n')
+        # Split on '\n' only: str.splitlines() also breaks on form feeds
+        # and other separators that Python's tokenizer does not count
+        lines = source.split('\n')
+        tree = ast.parse(source)
+
+        ast_visitor = AstVisitor()
+        ast_visitor.visit(tree)
+        # Each error list is built in line order so they can be merged at the end
+        var_errors: List[Tuple[int, str]] = []
+        for line_num, var in sorted(ast_visitor.vars.items()):
+            if not is_snakecase(var):
+                msg = f'{self.file_name}: Line {line_num}: S011 Variable \'{var}\' in function should be snake_case'
+                var_errors.append((line_num, msg))
+        arg_errors: List[Tuple[int, str]] = []
+        for line_num, arg in sorted(ast_visitor.arguments.items()):
+            if not is_snakecase(arg):
+                msg = f'{self.file_name}: Line {line_num}: S010 Argument name \'{arg}\' should be snake_case'
+                arg_errors.append((line_num, msg))
+        default_errors: List[Tuple[int, str]] = []
+        for line_num in sorted(ast_visitor.mut_defaults):
+            msg = f'{self.file_name}: Line {line_num}: S012 Default argument value is mutable'
+            default_errors.append((line_num, msg))
+
+        in_string = string_body_lines(source, len(lines))
+        # merge() is stable across its inputs, keeping S011, S010, S012 ahead of
+        # line checks reported for the same line; line checks run as it consumes them
+        yield from heapq.merge(var_errors, arg_errors, default_errors,
+                               self._line_errors(lines, in_string), key=itemgetter(0))
+
+    def _line_errors(self, lines: List[str], in_string: bytearray) -> Iterator[Tuple[int, str]]:
         line_count = 0
-        with open(self.file_name) as f:
-            lines = [line for line in f]
-            f.seek(0)
-            tree = ast.parse(f.read())
-
-            ast_visitor = AstVisitor()
-            ast_visitor.visit(tree)
-            for line_num, var in ast_visitor.vars.items():
-                if not is_snakecase(var):
-                    msg = f'{self.file_name}: Line {line_num}: S011 Variable \'{var}\' in function should be snake_case'
-                    self.errors.append((line_num, msg))
-            for line_num, arg in ast_visitor.arguments.items():
-                if not is_snakecase(arg):
-                    msg = f'{self.file_name}: Line {line_num}: S010 Argument name \'{arg}\' should be snake_case'
-                    self.errors.append((line_num, msg))
-            for line_num in ast_visitor.mut_defaults:
-                msg = f'{self.file_name}: Line {line_num}: S012 Default argument value is mutable'
-                self.errors.append((line_num, msg))
-
-            for line in lines:
-                line_count += 1
-                if len(line.strip()) == 0:
-                    self.blank_count += 1
+        blank_count = 0
+        for line in lines:
+            line_count += 1
+            inside = in_string[line_count]
+            if not inside and (not line or line.isspace()):
+                blank_count += 1
+                continue
+            ctx = line_context(line, blank_count)
+            for checker in self.checkers:
+                if checker.requires and not ctx.flags & checker.requires:
                     continue
-                for checker in self.checkers:
-                    if not checker.check(line):
-                        msg = ': '.join([self.file_name, f'Line {line_count}', f"S{checker.code:03d} " + checker.msg])
-                        self.errors.append((line_count, msg))
-
-                self.blank_count = 0
-        self.errors.sort(key=lambda x: x[0])
+                if inside and not checker.in_strings:
+                    continue
+                result = checker.check(ctx)
+                if result is not True:
+                    text = checker.msg if result is False else result
+                    msg = f'{self.file_name}: Line {line_count}: S{checker.code:03d} {text}'
+                    yield line_count, msg
 
+            blank_count = 0
@@ -1,37 +1,56 @@
 import os
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from file_sca import FileSCA
 
-if len(sys.argv) < 2:
-    print("error: Please provide a filename")
-    sys.exit(1)
-filename = sys.argv[1]
 
-
-# TODO account for multiline strings when porting this for resume
-# - i.e. prevent false positives
-
-
-files_to_check = []
-errors = []
-
-if os.path.isfile(filename) and filename.endswith(".py"):
-    files_to_check.append(filename)
-elif os.path.isdir(filename):
-    for dir_path, dir_names, file_names in os.walk(filename):
-        for f in file_names:
-            if f.endswith(".py"):
-                files_to_check.append(os.path.join(dir_path, f))
-else:
-    print("Error: Can't find given path")
-    sys.exit(1)
-
-files_to_check.sort()
-for f in files_to_check:
+def _analyze_one(path):
     # TODO refactor to make static method
-    sca = FileSCA(f)
-    sca.analyze()
-    errors = errors + [e[1] for e in sca.errors]
-
-for e in errors:
-    print(e)
+    return [msg for _, msg in FileSCA(path).analyze()]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("error: Please provide a filename")
+        sys.exit(1)
+    filename = sys.argv[1]
+
+    files_to_check = []
+
+    if os.path.isfile(filename) and filename.endswith(".py"):
+        files_to_check.append(filename)
+    elif os.path.isdir(filename):
+        for dir_path, dir_names, file_names in os.walk(filename):
+            for f in file_names:
+                if f.endswith(".py"):
+                    files_to_check.append(os.path.join(dir_path, f))
+    else:
+        print("Error: Can't find given path")
+        sys.exit(1)
+
+    files_to_check.sort()
+    # Files are independent. Only a bounded window of futures is kept in flight,
+    # and the oldest is printed before another is submitted, so output stays in
+    # files_to_check order and the parent holds a few files' errors at a time
+    if len(files_to_check) <= 1:
+        # Not worth starting worker processes for a single file
+        for f in files_to_check:
+            for e in _analyze_one(f):
+                print(e)
+        sys.exit(0)
+
+    max_workers = min(len(files_to_check), os.cpu_count() or 1)
+    if sys.platform == 'win32':
+        # ProcessPoolExecutor rejects more than 61 workers on Windows
+        max_workers = min(max_workers, 61)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for f in files_to_check:
+            if len(pending) >= 2 * max_workers:
+                for e in pending.popleft().result():
+                    print(e)
+            pending.append(executor.submit(_analyze_one, f))
+        while pending:
+            for e in pending.popleft().result():
+                print(e)